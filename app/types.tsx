@@ -34,4 +34,11 @@ export interface Insight {
   insightTitle: string;
   insight: string;
   insightType: string;
-}
\ No newline at end of file
+}
+export interface Analytics {
+  total_expenses: number;
+  total_income: number;
+  transaction_count: number;
+  by_category: Record<string, number>;
+  by_month: Record<string, { expenses: number; income: number }>;
+}
@@ -0,0 +1,291 @@
+"""
+Offline batch precomputation of insights and analytics rollups
+
+Streams the users collection in pages and regenerates insights and rollups for
+users whose transactions or categories changed since the last run. Results are
+written to financial_data, where get_insights already reads them.
+
+Unchanged users are found from document metadata: the insights state document
+records the financial_data update time the insights were built from, so only a
+projected read is needed unless the data was written to since.
+
+Progress is checkpointed after every page so an interrupted run resumes where it
+stopped. LLM concurrency and request rate are capped to stay inside the quota.
+
+Usage:
+    python batch_insights.py [--page-size 100] [--llm-concurrency 4] [--llm-rpm 60]
+
+Local run against the Firestore emulator and the stand-in LLM:
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python batch_insights.py --fake-llm
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent import futures
+from dotenv import load_dotenv
+from resilience import call, configure_pool, Deadline
+from insights import (
+    INSIGHTS_SCHEMA,
+    INSIGHTS_STATE_DOCUMENT,
+    build_insights_prompt,
+    finance_fingerprint,
+    precomputed_fields,
+    insights_state,
+    timestamp_key,
+)
+
+load_dotenv()
+
+DEFAULT_CHECKPOINT = 'batch_insights.checkpoint.json'
+# Time budget for one user: one read, one LLM call and one write
+USER_DEADLINE_SECONDS = float(os.environ.get('BATCH_USER_DEADLINE_SECONDS', 120))
+
+
+class FakeInsightsModel:
+    """
+    Local stand-in for the Gemini model
+    Returns canned insights after a fixed latency, without using any quota
+    Honours timeout the way the real client does
+    """
+
+    def __init__(self, latency_seconds=0.0, timeout=None):
+        self.latency_seconds = latency_seconds
+        self.timeout = timeout
+
+    def model_copy(self, update):
+        return FakeInsightsModel(self.latency_seconds, update.get('timeout', self.timeout))
+
+    def with_structured_output(self, schema):
+        return self
+
+    def invoke(self, prompt):
+        if self.timeout is not None and self.latency_seconds > self.timeout:
+            time.sleep(self.timeout)
+            raise TimeoutError('LLM stand-in timed out')
+        time.sleep(self.latency_seconds)
+        transaction_count = prompt.count('Title: ')
+        return {
+            'insights': [{
+                'id': '1',
+                'insightTitle': 'Spending summary',
+                'insight': f'You have {transaction_count} transactions this period.',
+                'insightType': 'tip',
+            }]
+        }
+
+
+class RateLimiter:
+    """
+    Spaces calls evenly so no more than requests_per_minute are started
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            slot = max(self.next_slot, time.monotonic())
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - time.monotonic()))
+
+
+def init_firestore():
+    """
+    Firestore client for the emulator when FIRESTORE_EMULATOR_HOST is set,
+    otherwise the project from the same credentials the server uses
+    """
+    if os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        # The emulator needs no credentials
+        from google.cloud import firestore as gcloud_firestore
+        return gcloud_firestore.Client(project=os.environ.get('GOOGLE_CLOUD_PROJECT', 'budgetbuddy-local'))
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    firebase_creds_json = os.environ.get('FIREBASE_CREDENTIALS_JSON')
+    if firebase_creds_json:
+        cred = credentials.Certificate(json.loads(firebase_creds_json))
+    else:
+        cred = credentials.Certificate(os.environ.get('FIREBASE_CREDENTIALS_PATH', './firebase-credentials.json'))
+    firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
+def init_llm(fake, fake_latency_seconds):
+    if fake:
+        return FakeInsightsModel(fake_latency_seconds)
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model="gemini-1.5-flash", api_key=os.environ.get('AI_CREDENTIALS'))
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    # Write then rename so a crash never leaves a half written checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def iter_user_pages(db, page_size, start_after_id=None):
+    """
+    Yield pages of user ids in document id order, starting after start_after_id
+    Only document names are fetched
+    """
+    users = db.collection('users')
+    cursor = users.document(start_after_id) if start_after_id else None
+    while True:
+        query = users.order_by('__name__').select(['__name__']).limit(page_size)
+        if cursor is not None:
+            query = query.start_after({'__name__': cursor})
+        page = [snapshot.id for snapshot in query.stream()]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        cursor = users.document(page[-1])
+
+
+def invoke_insights(llm, prompt, timeout):
+    """
+    Run the insights prompt with the remaining budget as the model's own request timeout,
+    so the call really ends at the deadline instead of being abandoned while it runs on
+    """
+    model = llm.model_copy(update={'timeout': timeout, 'max_retries': 1})
+    return model.with_structured_output(INSIGHTS_SCHEMA).invoke(prompt)
+
+
+def process_user(db, llm, limiter, user_id, force=False):
+    """
+    Recompute insights and rollups for one user if their data changed
+    Returns 'updated' or 'skipped'
+    """
+    deadline = Deadline(USER_DEADLINE_SECONDS)
+    finance = db.collection('users').document(user_id).collection('finance')
+    ref = finance.document('financial_data')
+    state_ref = finance.document(INSIGHTS_STATE_DOCUMENT)
+
+    # retry=None leaves retries to call(), see firestore_get in server.py
+    def read(doc_ref, **kwargs):
+        return call('firestore', lambda timeout: doc_ref.get(retry=None, timeout=timeout, **kwargs), idempotent=True, deadline=deadline)
+
+    def write_state(update_time):
+        call('firestore', lambda timeout: state_ref.set(insights_state(update_time), retry=None, timeout=timeout), deadline=deadline)
+
+    if not force:
+        # Metadata only: no write to financial_data since the insights were built means nothing to do
+        meta = read(ref, field_paths=['insights_fingerprint'])
+        if not meta.exists:
+            return 'skipped'
+        state = read(state_ref)
+        if state.exists and state.to_dict().get('source_update_time') == timestamp_key(meta.update_time):
+            return 'skipped'
+
+    snapshot = read(ref)
+    if not snapshot.exists:
+        return 'skipped'
+    finance_info = snapshot.to_dict()
+    if not force and finance_info.get('insights_fingerprint') == finance_fingerprint(finance_info):
+        # Written to, but not in a way that changes the insights
+        write_state(snapshot.update_time)
+        return 'skipped'
+
+    transactions = finance_info.get('transactions', [])
+    if transactions:
+        prompt = build_insights_prompt(transactions, finance_info.get('custom_categories', []))
+        limiter.wait()
+        res = call('gemini', lambda timeout: invoke_insights(llm, prompt, timeout), deadline=deadline)
+        insights = res.get('insights', [])
+    else:
+        # Nothing to advise on yet, e.g. a newly registered user: spend no LLM quota
+        insights = []
+    fields = precomputed_fields(finance_info, insights)
+    # Fails if the user changed their data meanwhile, they are picked up again on the next run
+    option = db.write_option(last_update_time=snapshot.update_time)
+    result = call('firestore', lambda timeout: ref.update(fields, option=option, retry=None, timeout=timeout), deadline=deadline)
+    write_state(result.update_time)
+    return 'updated'
+
+
+def run(db, llm, page_size=100, llm_concurrency=4, llm_rpm=0, checkpoint_path=DEFAULT_CHECKPOINT, restart=False, force=False):
+    """
+    Process every user, resuming from the checkpoint unless restart is set
+    Returns the run statistics
+    """
+    checkpoint = None if restart else load_checkpoint(checkpoint_path)
+    if checkpoint:
+        print(f"Resuming after user {checkpoint['last_user_id']}")
+        stats = checkpoint['stats']
+    else:
+        checkpoint = {'last_user_id': None}
+        stats = {'scanned': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+
+    # The gemini pool holds a slot until each LLM call really finishes, so calls given up
+    # at the deadline still count and the quota is never exceeded
+    configure_pool('gemini', llm_concurrency)
+    limiter = RateLimiter(llm_rpm)
+    started = time.monotonic()
+    scanned_this_run = 0
+
+    with futures.ThreadPoolExecutor(max_workers=llm_concurrency, thread_name_prefix='insights') as pool:
+        for page in iter_user_pages(db, page_size, checkpoint['last_user_id']):
+            jobs = {pool.submit(process_user, db, llm, limiter, user_id, force): user_id for user_id in page}
+            for job in futures.as_completed(jobs):
+                try:
+                    stats[job.result()] += 1
+                except Exception as e:
+                    print(f"Error processing user {jobs[job]}: {e}")
+                    stats['failed'] += 1
+            stats['scanned'] += len(page)
+            scanned_this_run += len(page)
+            checkpoint = {'last_user_id': page[-1], 'stats': stats}
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started
+            print(f"{stats['scanned']} users scanned, {stats['updated']} updated, {stats['skipped']} skipped, "
+                  f"{stats['failed']} failed, {scanned_this_run / elapsed:.1f} users/s")
+
+    # Finished cleanly, the next run starts from the beginning
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    elapsed = time.monotonic() - started
+    stats['users_per_second'] = scanned_this_run / elapsed if elapsed else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute insights and analytics rollups for all users')
+    parser.add_argument('--page-size', type=int, default=100, help='Users read per page')
+    parser.add_argument('--llm-concurrency', type=int, default=int(os.environ.get('LLM_MAX_CONCURRENCY', 4)),
+                        help='Maximum LLM calls in flight')
+    parser.add_argument('--llm-rpm', type=int, default=int(os.environ.get('LLM_REQUESTS_PER_MINUTE', 0)),
+                        help='Maximum LLM calls per minute, 0 for no limit')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='Checkpoint file used to resume')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the first user')
+    parser.add_argument('--force', action='store_true', help='Recompute users whose data did not change')
+    parser.add_argument('--fake-llm', action='store_true', help='Use the local LLM stand-in instead of Gemini')
+    parser.add_argument('--fake-llm-latency-ms', type=float, default=500, help='Latency of the LLM stand-in')
+    args = parser.parse_args()
+
+    db = init_firestore()
+    llm = init_llm(args.fake_llm, args.fake_llm_latency_ms / 1000)
+    stats = run(db, llm, args.page_size, args.llm_concurrency, args.llm_rpm, args.checkpoint, args.restart, args.force)
+    print(f"Done: {stats['scanned']} users scanned, {stats['updated']} updated, {stats['skipped']} skipped, "
+          f"{stats['failed']} failed, {stats['users_per_second']:.1f} users/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark for the API response layer
+Measures serialization time and bytes on the wire for a user with 10k transactions
+
+Usage: python bench_responses.py [transaction_count]
+"""
+import sys
+import json
+import time
+import random
+import responses
+
+CATEGORIES = [
+    ('Food', 'restaurant'),
+    ('Transport', 'car'),
+    ('Entertainment', 'film'),
+    ('Shopping', 'bag-handle'),
+    ('Housing', 'home'),
+    ('Health', 'medkit'),
+]
+
+
+def make_payload(count):
+    rng = random.Random(42)
+    transactions = []
+    for i in range(count):
+        category, icon = rng.choice(CATEGORIES)
+        transactions.append({
+            'id': str(1700000000000 + i),
+            'title': f'{category} purchase {i}',
+            'amount': round(rng.uniform(1, 250), 2),
+            'category': category,
+            'date': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00.000Z',
+            'isExpense': rng.random() < 0.9,
+            'icon': icon,
+        })
+    custom_categories = [{
+        'id': str(i + 1),
+        'category': category,
+        'allocated': 100,
+        'spent': 0,
+        'remaining': 100,
+        'period': 'monthly',
+        'color': '#F97316',
+        'icon': icon,
+    } for i, (category, icon) in enumerate(CATEGORIES)]
+    return {
+        'userId': 'bench-user',
+        'email': 'bench@example.com',
+        'name': 'Bench User',
+        'budget': 1000,
+        'used_budget': 0,
+        'transactions': transactions,
+        'custom_categories': custom_categories,
+        'error': False,
+    }
+
+
+def best_of(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    payload = make_payload(count)
+
+    print(f"Serialization ({count} transactions, best of 5)")
+    print(f"  jsonify-equivalent json.dumps: {best_of(lambda: json.dumps(payload, separators=(',', ':'), sort_keys=True)):8.2f} ms")
+    if responses.orjson is not None:
+        print(f"  orjson:                        {best_of(lambda: responses.dumps(payload)):8.2f} ms")
+    else:
+        print("  orjson:                        not installed")
+
+    cases = [
+        ('full payload', None),
+        ('?fields=custom_categories', 'custom_categories'),
+        ('?fields=transactions.id,transactions.amount', 'transactions.id,transactions.amount'),
+    ]
+    print("\nBytes on the wire")
+    print(f"  {'case':45} {'identity':>10} {'gzip':>10} {'br':>10}")
+    for name, raw in cases:
+        body = responses.dumps(responses.sparse(payload, responses.parse_fields(raw)))
+        sizes = [len(body), len(responses.compress(body, 'gzip'))]
+        if responses.brotli is not None:
+            sizes.append(len(responses.compress(body, 'br')))
+        sizes = [f'{size:>10,}' for size in sizes] + ['       n/a'] * (3 - len(sizes))
+        print(f"  {name:45} {' '.join(sizes)}")
+
+    body = responses.dumps(payload)
+    print("\nCompression time (full payload, best of 5)")
+    print(f"  gzip level {responses.GZIP_LEVEL}:     {best_of(lambda: responses.compress(body, 'gzip')):8.2f} ms")
+    if responses.brotli is not None:
+        print(f"  brotli quality {responses.BROTLI_QUALITY}: {best_of(lambda: responses.compress(body, 'br')):8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
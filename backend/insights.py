@@ -0,0 +1,139 @@
+import json
+import hashlib
+from collections import defaultdict
+
+# Sibling of financial_data recording which version of it the stored insights were built from.
+# Kept in its own document because writing it into financial_data would change that version again
+INSIGHTS_STATE_DOCUMENT = 'insights_state'
+
+# Structured output schema for insight generation
+INSIGHTS_SCHEMA = {
+    "title": "insights",
+    "description": "Provide insights",
+    "type": "object",
+    "properties": {
+        "insights": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {
+                        "type": "string",
+                        "description": "The id of the insight",
+                    },
+                    "insightTitle": {
+                        "type": "string",
+                        "description": "The title of the insight",
+                    },
+                    "insight": {
+                        "type": "string",
+                        "description": "The insight",
+                    },
+                    "insightType": {
+                        "type": "string",
+                        "description": "The type of insight can only be warning or tip (Tips are suggestions to improve your budget)",
+                    },
+                },
+                "required": ["id", "insightTitle", "insight", "insightType"],
+            },
+        },
+    },
+    "required": ["insights"],
+}
+
+
+def build_insights_prompt(transactions, categories):
+    """
+    Build the financial advisor prompt from a user's transactions and categories
+    """
+    prompt = "You are a financial advisor. Provide insights based on the following data:"
+    for transaction in transactions:
+        prompt += f"Title: {transaction['title']}\n"
+        prompt += f"Amount: {transaction['amount']}\n"
+        prompt += f"Category: {transaction['category']}\n"
+        prompt += f"Date: {transaction['date']}\n"
+        prompt += f"Is Expense: {transaction['isExpense']}\n"
+        prompt += f"Icon: {transaction['icon']}\n"
+        prompt += "\n"
+    for category in categories:
+        prompt += f"Category: {category['category']}\n"
+        prompt += f"Spent: {category['spent']}\n"
+        prompt += f"Remaining: {category['remaining']}\n"
+        prompt += "\n"
+    return prompt
+
+
+def finance_fingerprint(finance_info):
+    """
+    Hash of the data insights are generated from
+    Unchanged fingerprint means stored insights and rollups are still current
+    """
+    source = {
+        'transactions': finance_info.get('transactions', []),
+        'custom_categories': finance_info.get('custom_categories', []),
+    }
+    encoded = json.dumps(source, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def build_rollups(transactions):
+    """
+    Spending and income totals overall, per category and per month (YYYY-MM)
+    """
+    by_category = defaultdict(float)
+    by_month = defaultdict(lambda: {'expenses': 0.0, 'income': 0.0})
+    total_expenses = 0.0
+    total_income = 0.0
+    for transaction in transactions:
+        try:
+            amount = float(transaction.get('amount') or 0)
+        except (TypeError, ValueError):
+            continue
+        month = str(transaction.get('date') or '')[:7]
+        if transaction.get('isExpense', True):
+            total_expenses += amount
+            by_category[transaction.get('category', 'Other')] += amount
+            by_month[month]['expenses'] += amount
+        else:
+            total_income += amount
+            by_month[month]['income'] += amount
+    return {
+        'total_expenses': round(total_expenses, 2),
+        'total_income': round(total_income, 2),
+        'transaction_count': len(transactions),
+        'by_category': {category: round(amount, 2) for category, amount in by_category.items()},
+        'by_month': {
+            month: {key: round(amount, 2) for key, amount in totals.items()}
+            for month, totals in sorted(by_month.items())
+        },
+    }
+
+
+def precomputed_fields(finance_info, insights):
+    """
+    Fields written to financial_data alongside freshly generated insights
+    get_insights returns 'insights' and 'analytics', the fingerprint lets the
+    batch runner skip users whose data did not change
+    """
+    return {
+        'insights': insights,
+        'analytics': build_rollups(finance_info.get('transactions', [])),
+        'insights_fingerprint': finance_fingerprint(finance_info),
+    }
+
+
+def timestamp_key(timestamp):
+    """
+    Exact string form of a Firestore update time
+    Stored as a string because timestamp fields drop the nanoseconds
+    """
+    if hasattr(timestamp, 'rfc3339'):
+        return timestamp.rfc3339()
+    return timestamp.isoformat()
+
+
+def insights_state(update_time):
+    """
+    Contents of the insights state document after financial_data was written at update_time
+    """
+    return {'source_update_time': timestamp_key(update_time)}
@@ -0,0 +1,323 @@
+import os
+import time
+import random
+import threading
+from concurrent import futures
+from flask import g, has_request_context
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    GOOGLE_TRANSIENT_ERRORS = (
+        google_exceptions.TooManyRequests,
+        google_exceptions.InternalServerError,
+        google_exceptions.BadGateway,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.GatewayTimeout,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.Aborted,
+    )
+except ImportError:
+    GOOGLE_TRANSIENT_ERRORS = ()
+
+try:
+    from firebase_admin import exceptions as firebase_exceptions
+    from firebase_admin import auth as firebase_auth
+    FIREBASE_TRANSIENT_ERRORS = (
+        # Fetching the public keys that verify ID tokens failed
+        firebase_auth.CertificateFetchError,
+        firebase_exceptions.UnavailableError,
+        firebase_exceptions.DeadlineExceededError,
+        firebase_exceptions.InternalError,
+        firebase_exceptions.ResourceExhaustedError,
+        firebase_exceptions.AbortedError,
+    )
+except ImportError:
+    FIREBASE_TRANSIENT_ERRORS = ()
+
+# Errors worth retrying: the dependency may succeed if asked again
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError) + GOOGLE_TRANSIENT_ERRORS + FIREBASE_TRANSIENT_ERRORS
+
+# Total time a request may spend, clients can ask for less with X-Request-Deadline-Ms
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 10))
+MAX_RETRIES = int(os.environ.get('DEPENDENCY_MAX_RETRIES', 2))
+BACKOFF_BASE_SECONDS = 0.1
+BACKOFF_MAX_SECONDS = 2.0
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 30))
+# Calls in flight per dependency, abandoned calls keep their slot until they really finish
+DEPENDENCY_POOL_SIZE = int(os.environ.get('DEPENDENCY_POOL_SIZE', 16))
+
+
+class DependencyError(Exception):
+    """
+    Base class for errors raised when a dependency cannot be used
+    """
+    status_code = 503
+
+    def __init__(self, dependency, message):
+        super().__init__(message)
+        self.dependency = dependency
+
+
+class DeadlineExceeded(DependencyError):
+    """
+    The request's deadline ran out before a dependency call finished
+    """
+    status_code = 504
+
+
+class CircuitOpenError(DependencyError):
+    """
+    The dependency's circuit breaker is open, the call was not attempted
+    """
+    status_code = 503
+
+    def __init__(self, dependency, message, retry_after):
+        super().__init__(dependency, message)
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """
+    Time budget for a unit of work, shared by every dependency call made for it
+    client_shortened marks budgets a client cut below the server limit, running
+    out of those says nothing about the dependency's health
+    """
+
+    def __init__(self, seconds, client_shortened=False):
+        self.expires_at = time.monotonic() + seconds
+        self.client_shortened = client_shortened
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """
+    Per-dependency circuit breaker
+    Opens after failure_threshold consecutive failed calls, then lets a single
+    trial call through once reset_seconds have passed
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_seconds and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            retry_after = max(0.0, self.reset_seconds - waited)
+        raise CircuitOpenError(self.name, f'{self.name} is unavailable, circuit breaker is open', retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def release(self):
+        """
+        End a call that says nothing about the dependency's health
+        Lets the next trial through if this call was one
+        """
+        with self._lock:
+            self.trial_in_flight = False
+
+
+class DependencyPool:
+    """
+    Bounded thread pool for one dependency
+    A slot is held until the call really finishes, so calls abandoned at the
+    deadline still count and a slow dependency cannot starve the others
+    """
+
+    def __init__(self, name, size=DEPENDENCY_POOL_SIZE):
+        self.name = name
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._executor = futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix=name)
+
+    def submit(self, fn, deadline, block=True):
+        """
+        Start fn with the remaining budget once a slot is free
+        Raises DeadlineExceeded if none frees up in time, or returns None when block is False
+        """
+        if block:
+            acquired = self._slots.acquire(timeout=deadline.remaining())
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            if not block:
+                return None
+            raise DeadlineExceeded(self.name, f'{self.name} has no free capacity before the request deadline')
+        try:
+            future = self._executor.submit(fn, deadline.remaining())
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+_breakers = {}
+_pools = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(dependency):
+    with _registry_lock:
+        if dependency not in _breakers:
+            _breakers[dependency] = CircuitBreaker(dependency)
+        return _breakers[dependency]
+
+
+def get_pool(dependency):
+    with _registry_lock:
+        if dependency not in _pools:
+            _pools[dependency] = DependencyPool(dependency)
+        return _pools[dependency]
+
+
+def configure_pool(dependency, size):
+    """
+    Set how many calls to a dependency may be in flight, e.g. to match an LLM quota
+    Must be called before the dependency is first used
+    """
+    with _registry_lock:
+        _pools[dependency] = DependencyPool(dependency, size)
+        return _pools[dependency]
+
+
+def start_request_deadline(header_value=None):
+    """
+    Start the deadline for the current request
+    A client supplied deadline in milliseconds can only shorten the server limit
+    """
+    seconds = REQUEST_DEADLINE_SECONDS
+    client_shortened = False
+    if header_value:
+        try:
+            requested = max(0.0, float(header_value) / 1000)
+        except ValueError:
+            requested = seconds
+        if requested < seconds:
+            seconds = requested
+            client_shortened = True
+    g.deadline = Deadline(seconds, client_shortened)
+    return g.deadline
+
+
+def current_deadline():
+    """
+    Deadline of the current request, or a fresh default one outside a request
+    """
+    if has_request_context():
+        if 'deadline' not in g:
+            start_request_deadline()
+        return g.deadline
+    return Deadline(REQUEST_DEADLINE_SECONDS)
+
+
+def _attempt(dependency, fn, deadline, hedge_after):
+    """
+    Run one attempt of fn, abandoning it when the deadline runs out
+    With hedge_after set, a second copy is started if the first is slow and
+    whichever finishes first wins
+    """
+    pool = get_pool(dependency)
+    pending = {pool.submit(fn, deadline)}
+    if hedge_after is not None and hedge_after < deadline.remaining():
+        done, _ = futures.wait(pending, timeout=hedge_after)
+        if not done:
+            # Only hedge with spare capacity, never queue behind other calls for it
+            hedge = pool.submit(fn, deadline, block=False)
+            if hedge is not None:
+                pending.add(hedge)
+
+    error = None
+    while pending:
+        done, pending = futures.wait(pending, timeout=deadline.remaining(), return_when=futures.FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    if error is not None:
+        raise error
+    raise DeadlineExceeded(dependency, f'{dependency} did not respond before the request deadline')
+
+
+def call(dependency, fn, idempotent=False, hedge_after=None, deadline=None):
+    """
+    Call a dependency within the deadline and behind its circuit breaker
+    fn receives the remaining time budget in seconds to pass on as its own timeout
+    Idempotent calls are retried on transient errors with jittered backoff
+    and may be hedged after hedge_after seconds
+    A call counts as at most one failure against the breaker however many attempts it made
+    """
+    deadline = deadline or current_deadline()
+    if deadline.expired():
+        raise DeadlineExceeded(dependency, f'Request deadline exceeded before calling {dependency}')
+    breaker = get_breaker(dependency)
+    retries = MAX_RETRIES if idempotent else 0
+    if not idempotent:
+        hedge_after = None
+
+    breaker.before_call()
+    # Reported to the breaker once when the call ends: True healthy, False failed, None says nothing
+    healthy = None
+    try:
+        attempt = 0
+        while True:
+            try:
+                result = _attempt(dependency, fn, deadline, hedge_after)
+            except DeadlineExceeded:
+                # Only the server's own budget running out is the dependency's fault
+                if not deadline.client_shortened:
+                    healthy = False
+                raise
+            except TRANSIENT_ERRORS as e:
+                healthy = False
+                if attempt >= retries:
+                    raise DependencyError(dependency, f'{dependency} is unavailable: {e}') from e
+                # Full jitter backoff, never sleeping past the deadline
+                backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                if backoff >= deadline.remaining():
+                    raise DeadlineExceeded(dependency, f'{dependency} failed and no time is left to retry: {e}')
+                time.sleep(backoff)
+                attempt += 1
+            except Exception:
+                # The dependency answered, the request itself was bad
+                healthy = True
+                raise
+            else:
+                healthy = True
+                return result
+    finally:
+        if healthy:
+            breaker.record_success()
+        elif healthy is False:
+            breaker.record_failure()
+        else:
+            breaker.release()
@@ -0,0 +1,172 @@
+import os
+import gzip
+import json
+import datetime
+from flask import request, make_response
+
+# orjson and brotli are optional: fall back to the standard library when they
+# are not installed so the server still runs in a bare environment
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as-is, compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _default(value):
+    # Firestore timestamps are datetime subclasses, which orjson does not encode itself
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(payload):
+    """
+    Serialize a payload to JSON bytes
+    Uses orjson when available, otherwise the standard json module
+    Both encode datetimes as ISO 8601 and anything else unknown with str()
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def parse_fields(raw):
+    """
+    Parse a ?fields= value into {top_level_key: set_of_subkeys or None}
+    e.g. "custom_categories,transactions.id,transactions.amount" becomes
+    {'custom_categories': None, 'transactions': {'id', 'amount'}}
+    None as the value means the whole field is kept
+    Returns None when no fields were requested
+    """
+    if not raw:
+        return None
+    fields = {}
+    for item in raw.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, subkey = item.partition('.')
+        if not subkey or fields.get(key, set()) is None:
+            fields[key] = None
+        else:
+            fields.setdefault(key, set()).add(subkey)
+    return fields or None
+
+
+def requested_fields():
+    """
+    Fields requested on the current request through ?fields=
+    """
+    return parse_fields(request.args.get('fields', ''))
+
+
+def field_paths(fields, available):
+    """
+    Firestore field paths needed to serve the requested fields
+    Only keys stored in the document (available) are projected
+    Returns None when the whole document should be read
+    """
+    if fields is None:
+        return None
+    return [key for key in available if key in fields]
+
+
+def _trim(value, subkeys):
+    if subkeys is None:
+        return value
+    if isinstance(value, list):
+        return [_trim(item, subkeys) for item in value]
+    if isinstance(value, dict):
+        return {key: item for key, item in value.items() if key in subkeys}
+    return value
+
+
+def sparse(payload, fields):
+    """
+    Trim a response payload down to the requested fields
+    The 'error' flag is always kept so clients can still check it
+    """
+    if fields is None:
+        return payload
+    trimmed = {key: _trim(payload[key], subkeys) for key, subkeys in fields.items() if key in payload}
+    if 'error' in payload:
+        trimmed['error'] = payload['error']
+    return trimmed
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick the content coding with the highest q-value from an Accept-Encoding header
+    Server preference (brotli, gzip, identity) only breaks ties, returns None for identity
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+
+    candidates = ['gzip', None]
+    if brotli is not None:
+        candidates.insert(0, 'br')
+    best, best_quality = None, 0.0
+    for coding in candidates:
+        if coding is None:
+            # identity is acceptable unless excluded, as a last resort when not listed
+            quality = accepted.get('identity', 0.001)
+        else:
+            quality = accepted.get(coding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(body, encoding):
+    """
+    Compress a response body with the given content coding
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+def api_response(payload, status=200, fields=None):
+    """
+    Build a JSON response for an API route
+    Applies sparse fieldsets, fast serialization and negotiated compression
+    """
+    body = dumps(sparse(payload, fields))
+    encoding = None
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        body = compress(body, encoding)
+
+    response = make_response(body, status)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
@@ -7,8 +7,12 @@ from flask_cors import CORS
 import firebase_admin
 from firebase_admin import credentials, auth
 from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
+from responses import api_response, requested_fields, field_paths
+from resilience import call, start_request_deadline, DependencyError, CircuitOpenError, REQUEST_DEADLINE_SECONDS
+from insights import INSIGHTS_SCHEMA, INSIGHTS_STATE_DOCUMENT, build_insights_prompt, precomputed_fields, insights_state
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -32,7 +36,8 @@ try:
         cred_path = os.environ.get('FIREBASE_CREDENTIALS_PATH', './firebase-credentials.json')
         cred = credentials.Certificate(cred_path)
         
-    firebase_admin.initialize_app(cred)
+    # Auth calls take no per-call timeout, so bound them by the request deadline here
+    firebase_admin.initialize_app(cred, {'httpTimeout': REQUEST_DEADLINE_SECONDS})
     db = firestore.client()
     print("Firebase initialized successfully")
 except Exception as e:
@@ -50,6 +55,55 @@ except Exception as e:
     print(f"Error initializing AI: {e}")
 
 
+# Hedge slow Firestore reads after this many milliseconds, 0 disables hedging
+FIRESTORE_HEDGE_AFTER_MS = float(os.environ.get('FIRESTORE_HEDGE_AFTER_MS', 0))
+
+
+# Dependency calls, each bounded by the request deadline and a circuit breaker.
+# Firestore calls pass retry=None: the library's own retries would keep an abandoned
+# call running for minutes past the deadline, call() owns the retries instead
+def firestore_get(ref, **kwargs):
+    hedge_after = FIRESTORE_HEDGE_AFTER_MS / 1000 if FIRESTORE_HEDGE_AFTER_MS > 0 else None
+    return call('firestore', lambda timeout: ref.get(retry=None, timeout=timeout, **kwargs), idempotent=True, hedge_after=hedge_after)
+
+def firestore_set(ref, data):
+    return call('firestore', lambda timeout: ref.set(data, retry=None, timeout=timeout))
+
+def firestore_update(ref, data, **kwargs):
+    return call('firestore', lambda timeout: ref.update(data, retry=None, timeout=timeout, **kwargs))
+
+def firebase_get_user(uid):
+    return call('firebase_auth', lambda timeout: auth.get_user(uid), idempotent=True)
+
+def firebase_verify_id_token(token):
+    # The public key fetch behind this is bounded by the httpTimeout app option
+    return call('firebase_auth', lambda timeout: auth.verify_id_token(token, check_revoked=False), idempotent=True)
+
+def ai_invoke(schema, prompt):
+    def invoke(timeout):
+        # A copy of the model carries the remaining budget as its request timeout,
+        # retries are left to call() so they stay inside the deadline
+        model = ai.model_copy(update={'timeout': timeout, 'max_retries': 1})
+        return model.with_structured_output(schema).invoke(prompt)
+    return call('gemini', invoke)
+
+
+@app.before_request
+def start_deadline():
+    start_request_deadline(request.headers.get('X-Request-Deadline-Ms'))
+
+@app.errorhandler(DependencyError)
+def handle_dependency_error(e):
+    """
+    Report timeouts and open circuit breakers as 504/503 instead of a generic 400
+    """
+    response = jsonify({'message': str(e), 'dependency': e.dependency, 'error': True})
+    response.status_code = e.status_code
+    if isinstance(e, CircuitOpenError):
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+    return response
+
+
 # Authentication decorator
 def token_required(f):
     @wraps(f)
@@ -70,11 +124,13 @@ def token_required(f):
                 'check_revoked': False      # Don't check if token has been revoked
             }
             
-            decoded_token = auth.verify_id_token(token, check_revoked=False)
+            decoded_token = firebase_verify_id_token(token)
             
             # Add user_id to kwargs to be used in the route function
             kwargs['user_id'] = decoded_token['uid']
             return f(*args, **kwargs)
+        except DependencyError:
+            raise
         except Exception as e:
             return jsonify({'message': f'Invalid token: {str(e)}', 'error': True}), 401
             
@@ -156,11 +212,11 @@ def register():
         }
     ]
     try:
-        db.collection('users').document(uid).set({
+        firestore_set(db.collection('users').document(uid), {
             'email': email,
             'name': name
         })
-        db.collection('users').document(uid).collection('finance').document('financial_data').set({
+        firestore_set(db.collection('users').document(uid).collection('finance').document('financial_data'), {
             'budget': 1000,
             'used': 0,
             'transactions': [],
@@ -175,6 +231,8 @@ def register():
             'name': name,
             'error': False
         }), 201
+    except DependencyError:
+        raise
     except Exception as e:
         print(f"Error creating user: {e}")
         return jsonify({'message': str(e), 'error': True}), 400
@@ -185,15 +243,21 @@ def get_user(user_id):
     """
     Get user details from Firebase Auth
     Requires a valid Firebase ID token
+    Optional ?fields= trims the response, e.g. ?fields=custom_categories
     """
     try:
-        user_data = db.collection('users').document(user_id).get()
-        budget_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        fields = requested_fields()
+        # Only read the finance fields the client asked for
+        budget_fields = field_paths(fields, ['budget', 'used_budget', 'transactions', 'custom_categories'])
+        user_data = firestore_get(db.collection('users').document(user_id))
         if not user_data.exists:
             return jsonify({'message': 'User not found', 'error': True}), 404
         user_info = user_data.to_dict()
-        budget_info = budget_data.to_dict()
-        return jsonify({
+        budget_info = {}
+        if budget_fields is None or budget_fields:
+            budget_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'), field_paths=budget_fields)
+            budget_info = budget_data.to_dict() or {}
+        return api_response({
             'userId': user_id,
             'email': user_info.get('email', ''),
             'name': user_info.get('name', ''),
@@ -202,7 +266,9 @@ def get_user(user_id):
             'transactions': budget_info.get('transactions', []),
             'custom_categories': budget_info.get('custom_categories', []),
             'error': False
-        }), 200
+        }, 200, fields)
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -221,11 +287,11 @@ def verify_token():
         
         # Verify token
         # For Firebase Admin 6.2.0, we use check_revoked=False to be more permissive with token timing
-        decoded_token = auth.verify_id_token(token, check_revoked=False)
+        decoded_token = firebase_verify_id_token(token)
         
         # Get user from Firebase Auth
         user_id = decoded_token['uid']
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         return jsonify({
             'userId': user.uid,
@@ -234,6 +300,8 @@ def verify_token():
             'emailVerified': user.email_verified,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 401
 
@@ -250,7 +318,7 @@ def add_expense(user_id):
         expense_title = data.get('title')
         expense_amount = data.get('amount')
         expense_category = data.get('category')
-        expense_icon = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        expense_icon = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         expense_icon = expense_icon.to_dict().get('custom_categories', [])
         if expense_category.lower() == "auto":
             json_schema = {
@@ -265,12 +333,11 @@ def add_expense(user_id):
                 },
                 "required": ["category"],
             }
-            auto_category = ai.with_structured_output(json_schema)
             categories = ""
             for category in expense_icon:
                 categories += category['category'] + ", "
             prompt = "Catogorise the expense based on the description and choose only one category from the list: description: " + expense_title + ","+ " category: " + categories
-            result = auto_category.invoke(prompt)
+            result = ai_invoke(json_schema, prompt)
             expense_category = result['category']
         expense_date = data.get('date')
         expense_isExpense = data.get('isExpense')
@@ -292,14 +359,14 @@ def add_expense(user_id):
         }
         
         # Get user from Firebase Auth
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         # Add expense to user's finance data
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'transactions': firestore.ArrayUnion([expense])
         })
 
-        custom_categories = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        custom_categories = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         custom_categories = custom_categories.to_dict().get('custom_categories', [])
         for category in custom_categories:
             if category['category'].lower() == expense_category.lower():
@@ -307,7 +374,7 @@ def add_expense(user_id):
                 category['remaining'] -= expense_amount
                 break
         
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'custom_categories': custom_categories
         })
         
@@ -317,6 +384,8 @@ def add_expense(user_id):
             'userId': user_id,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -326,14 +395,18 @@ def get_user_transactions(user_id):
     """
     Get user transactions
     Requires a valid Firebase ID token
+    Optional ?fields= trims the response, e.g. ?fields=transactions.id,transactions.amount
     """
     try:
-        transaction_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        fields = requested_fields()
+        transaction_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'), field_paths=['transactions'])
         transaction_info = transaction_data.to_dict()
-        return jsonify({
+        return api_response({
             'transactions': transaction_info.get('transactions', []),
             'error': False
-        }), 200
+        }, 200, fields)
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -356,10 +429,10 @@ def add_category(user_id):
         category_icon = data.get('icon')
         
         # Get user from Firebase Auth
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         # Add category to user's finance data
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'custom_categories': firestore.ArrayUnion([{
                 'id': category_id,
                 'category': category_category,
@@ -377,6 +450,8 @@ def add_category(user_id):
             'userId': user_id,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -400,10 +475,10 @@ def update_category(user_id):
         print(data)
         
         # Get user from Firebase Auth
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         # Update category in user's finance data
-        category_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        category_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         category_data = category_data.to_dict().get('custom_categories', [])
         for category in category_data:
             if category['id'] == category_id:
@@ -416,7 +491,7 @@ def update_category(user_id):
                 category['icon'] = category_icon
                 break
         
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'custom_categories': category_data
         })
         
@@ -425,6 +500,8 @@ def update_category(user_id):
             'userId': user_id,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -446,10 +523,10 @@ def update_transaction(user_id):
         transaction_icon = data.get('icon')
         
         # Get user from Firebase Auth
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         # Update transaction in user's finance data
-        transaction_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        transaction_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         transaction_data = transaction_data.to_dict().get('transactions', [])
         for transaction in transaction_data:
             if transaction['id'] == transaction_id:
@@ -463,7 +540,7 @@ def update_transaction(user_id):
                 transaction['icon'] = transaction_icon
                 break
         
-        current_category = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        current_category = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         current_category = current_category.to_dict().get('custom_categories', [])
         for category in current_category:
             print(category['category'])
@@ -473,11 +550,11 @@ def update_transaction(user_id):
                 category['remaining'] += temp_amount
                 break
        
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'custom_categories': current_category
         })
 
-        custom_categories = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        custom_categories = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         custom_categories = custom_categories.to_dict().get('custom_categories', [])
         for category in custom_categories:
             if category['category'].lower() == transaction_category.lower():
@@ -485,7 +562,7 @@ def update_transaction(user_id):
                 category['remaining'] -= transaction_amount
                 break
         
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'custom_categories': custom_categories,
             'transactions': transaction_data
         })
@@ -495,6 +572,8 @@ def update_transaction(user_id):
             'userId': user_id,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -514,11 +593,11 @@ def delete_transaction(user_id):
         
         
         # Get user from Firebase Auth
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         # Delete transaction from user's finance data
         print("0")
-        transaction_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        transaction_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         transaction_data = transaction_data.to_dict().get('transactions', [])
         for transaction in transaction_data:
             if transaction['id'] == transaction_id:
@@ -526,7 +605,7 @@ def delete_transaction(user_id):
                 temp_category = transaction['category']
                 transaction_data.remove(transaction)
                 break
-        category_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        category_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         category_data = category_data.to_dict().get('custom_categories', [])
         for category in category_data:
             if category['category'] == temp_category:
@@ -534,7 +613,7 @@ def delete_transaction(user_id):
                 category['remaining'] = category['remaining'] + temp
                 break
         
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'transactions': transaction_data,
             'custom_categories': category_data,
         })
@@ -544,6 +623,8 @@ def delete_transaction(user_id):
             'userId': user_id,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         print(e)
         return jsonify({'message': str(e), 'error': True}), 400
@@ -560,17 +641,17 @@ def delete_category(user_id):
         category_id = data.get('id')
         
         # Get user from Firebase Auth
-        user = auth.get_user(user_id)
+        user = firebase_get_user(user_id)
         
         # Delete category from user's finance data
-        category_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        category_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'))
         category_data = category_data.to_dict().get('custom_categories', [])
         for category in category_data:
             if category['id'] == category_id:
                 category_data.remove(category)
                 break
 
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
+        firestore_update(db.collection('users').document(user_id).collection('finance').document('financial_data'), {
             'custom_categories': category_data
         })
         
@@ -579,78 +660,43 @@ def delete_category(user_id):
             'userId': user_id,
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
 @app.route('/api/auth/user/generateInsights', methods=['GET'])
 @token_required
 def generate_insights(user_id):
-
-    json_schema = {
-                "title": "insights",
-                "description": "Provide insights",
-                "type": "object",
-                "properties": {
-                    "insights": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "id": {
-                                    "type": "string",
-                                    "description": "The id of the insight",
-                                },
-                                "insightTitle": {
-                                    "type": "string",
-                                    "description": "The title of the insight",
-                                },
-                                "insight": {
-                                    "type": "string",
-                                    "description": "The insight",
-                                },
-                                "insightType": {
-                                    "type": "string",
-                                    "description": "The type of insight can only be warning or tip (Tips are suggestions to improve your budget)",
-                                },
-                            },
-                            "required": ["id", "insightTitle", "insight", "insightType"],
-                        },
-                    },
-                },
-                "required": ["insights"],
-            }
     try:
-        insightAi = ai.with_structured_output(json_schema)
-        transaction_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
-        transaction_data = transaction_data.to_dict()
+        finance_ref = db.collection('users').document(user_id).collection('finance').document('financial_data')
+        snapshot = firestore_get(finance_ref)
+        transaction_data = snapshot.to_dict()
         transaction_info = transaction_data.get('transactions', [])
         category_data = transaction_data.get('custom_categories', [])
-        prompt = "You are a financial advisor. Provide insights based on the following data:"
-        for transaction in transaction_info:
-            prompt += f"Title: {transaction['title']}\n"
-            prompt += f"Amount: {transaction['amount']}\n"
-            prompt += f"Category: {transaction['category']}\n"
-            prompt += f"Date: {transaction['date']}\n"
-            prompt += f"Is Expense: {transaction['isExpense']}\n"
-            prompt += f"Icon: {transaction['icon']}\n"
-            prompt += "\n"
-        for category in category_data:
-            prompt += f"Category: {category['category']}\n"
-            prompt += f"Spent: {category['spent']}\n"
-            prompt += f"Remaining: {category['remaining']}\n"
-            prompt += "\n"
-        res = insightAi.invoke(prompt)
+        prompt = build_insights_prompt(transaction_info, category_data)
+        res = ai_invoke(INSIGHTS_SCHEMA, prompt)
         print(res)
         insights = res.get('insights', [])
-        #update insights in database
-        db.collection('users').document(user_id).collection('finance').document('financial_data').update({
-            'insights': insights
-        })
+        #update insights, rollups and fingerprint in database
+        fields = precomputed_fields(transaction_data, insights)
+        try:
+            #only if the data did not change during the LLM call
+            result = firestore_update(finance_ref, fields, option=db.write_option(last_update_time=snapshot.update_time))
+            #record which version of the data they were built from so the batch runner skips this user
+            firestore_set(db.collection('users').document(user_id).collection('finance').document(INSIGHTS_STATE_DOCUMENT), insights_state(result.update_time))
+        except FailedPrecondition:
+            #the user changed their data meanwhile: store these insights but leave the state
+            #untouched, so the batch runner rebuilds them from the new data
+            firestore_update(finance_ref, fields)
         print(insights)
         return jsonify({
             'insights': insights,
+            'analytics': fields['analytics'],
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -658,12 +704,15 @@ def generate_insights(user_id):
 @token_required
 def get_insights(user_id):
     try:
-        insights_data = db.collection('users').document(user_id).collection('finance').document('financial_data').get()
+        insights_data = firestore_get(db.collection('users').document(user_id).collection('finance').document('financial_data'), field_paths=['insights', 'analytics'])
         insights_info = insights_data.to_dict()
         return jsonify({
             'insights': insights_info.get('insights', []),
+            'analytics': insights_info.get('analytics', {}),
             'error': False
         }), 200
+    except DependencyError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e), 'error': True}), 400
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend modules are run as scripts from backend/, make them importable the same way
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
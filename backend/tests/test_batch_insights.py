@@ -0,0 +1,308 @@
+import copy
+import time
+import datetime
+import threading
+import pytest
+import resilience
+import batch_insights
+from insights import INSIGHTS_STATE_DOCUMENT
+
+
+# Marks a call that left the client library's own retry policy in place
+LIBRARY_RETRY = object()
+
+
+def check_retry(retry):
+    # The library would keep retrying past the deadline, call() must own retries
+    assert retry is None, 'Firestore calls must pass retry=None'
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class Snapshot:
+    def __init__(self, doc_id, data, update_time):
+        self.id = doc_id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeFirestore:
+    """
+    In-memory stand-in for the parts of the Firestore client the batch runner uses
+    Records full and projected reads of financial_data
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.update_times = {}
+        self.full_finance_reads = 0
+        self.fail_stream_after = None
+        self.streams = 0
+        self._clock = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self._lock = threading.Lock()
+
+    def tick(self):
+        with self._lock:
+            self._clock += datetime.timedelta(microseconds=1)
+            return self._clock
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    @staticmethod
+    def write_option(last_update_time):
+        return {'last_update_time': last_update_time}
+
+    def put(self, path, data):
+        self.docs[path] = copy.deepcopy(data)
+        self.update_times[path] = self.tick()
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path.split('/')[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.db, f'{self.path}/{name}')
+
+    def get(self, timeout=None, field_paths=None, retry=LIBRARY_RETRY):
+        check_retry(retry)
+        data = self.db.docs.get(self.path)
+        if data is not None and field_paths is not None:
+            data = {key: value for key, value in data.items() if key in field_paths}
+        elif data is not None and self.path.endswith('/financial_data'):
+            self.db.full_finance_reads += 1
+        return Snapshot(self.id, copy.deepcopy(data), self.db.update_times.get(self.path))
+
+    def set(self, data, timeout=None, retry=LIBRARY_RETRY):
+        check_retry(retry)
+        self.db.put(self.path, data)
+        return WriteResult(self.db.update_times[self.path])
+
+    def update(self, fields, option=None, timeout=None, retry=LIBRARY_RETRY):
+        check_retry(retry)
+        if option and option['last_update_time'] != self.db.update_times[self.path]:
+            raise RuntimeError('FailedPrecondition: document was modified')
+        data = self.db.docs[self.path]
+        data.update(copy.deepcopy(fields))
+        self.db.put(self.path, data)
+        return WriteResult(self.db.update_times[self.path])
+
+
+class FakeCollection:
+    def __init__(self, db, path, limit=None, after=None):
+        self.db = db
+        self.path = path
+        self._limit = limit
+        self._after = after
+
+    def document(self, doc_id):
+        return FakeDocument(self.db, f'{self.path}/{doc_id}')
+
+    def order_by(self, field):
+        return self
+
+    def select(self, field_paths):
+        return self
+
+    def limit(self, count):
+        return FakeCollection(self.db, self.path, count, self._after)
+
+    def start_after(self, values):
+        return FakeCollection(self.db, self.path, self._limit, values['__name__'].id)
+
+    def stream(self):
+        self.db.streams += 1
+        if self.db.fail_stream_after is not None and self.db.streams > self.db.fail_stream_after:
+            raise ConnectionError('interrupted')
+        depth = self.path.count('/') + 1
+        ids = sorted(path.split('/')[-1] for path in self.db.docs
+                     if path.startswith(self.path + '/') and path.count('/') == depth)
+        ids = [doc_id for doc_id in ids if self._after is None or doc_id > self._after]
+        return [Snapshot(doc_id, {}, None) for doc_id in ids[:self._limit]]
+
+
+def make_db(user_count):
+    db = FakeFirestore()
+    for i in range(user_count):
+        user_id = f'user{i:03d}'
+        db.put(f'users/{user_id}', {'email': f'{user_id}@example.com'})
+        db.put(f'users/{user_id}/finance/financial_data', {
+            'budget': 1000,
+            'transactions': [{'id': '1', 'title': 'Lunch', 'amount': 12.5, 'category': 'Food',
+                              'date': '2024-05-01T12:00:00.000Z', 'isExpense': True, 'icon': 'restaurant'}],
+            'custom_categories': [{'id': '1', 'category': 'Food', 'spent': 12.5, 'remaining': 87.5}],
+        })
+    return db
+
+
+class CountingModel(batch_insights.FakeInsightsModel):
+    """LLM stand-in that records calls and, unlike the real client, ignores its timeout"""
+
+    def __init__(self, latency_seconds=0.0):
+        super().__init__(latency_seconds)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def model_copy(self, update):
+        return self
+
+    def invoke(self, prompt):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency_seconds)
+            return {'insights': [{'id': '1', 'insightTitle': 't', 'insight': 'i', 'insightType': 'tip'}]}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(resilience, '_breakers', {})
+    monkeypatch.setattr(resilience, '_pools', {})
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    return str(tmp_path / 'checkpoint.json')
+
+
+def test_first_run_writes_insights_where_get_insights_reads_them(checkpoint):
+    db = make_db(5)
+    stats = batch_insights.run(db, CountingModel(), page_size=2, checkpoint_path=checkpoint)
+    assert (stats['scanned'], stats['updated'], stats['skipped'], stats['failed']) == (5, 5, 0, 0)
+    finance = db.docs['users/user000/finance/financial_data']
+    assert finance['insights'][0]['insightType'] == 'tip'
+    assert finance['analytics']['by_category'] == {'Food': 12.5}
+    assert f'users/user000/finance/{INSIGHTS_STATE_DOCUMENT}' in db.docs
+
+
+def test_unchanged_users_are_skipped_from_metadata(checkpoint):
+    db = make_db(5)
+    batch_insights.run(db, CountingModel(), page_size=2, checkpoint_path=checkpoint)
+    db.full_finance_reads = 0
+    model = CountingModel()
+    stats = batch_insights.run(db, model, page_size=2, checkpoint_path=checkpoint)
+    assert (stats['updated'], stats['skipped']) == (0, 5)
+    assert model.calls == 0
+    assert db.full_finance_reads == 0
+
+
+def test_changed_user_is_recomputed(checkpoint):
+    db = make_db(5)
+    batch_insights.run(db, CountingModel(), page_size=2, checkpoint_path=checkpoint)
+    path = 'users/user003/finance/financial_data'
+    data = db.docs[path]
+    data['transactions'].append({'id': '2', 'title': 'Salary', 'amount': 100, 'category': 'Income',
+                                 'date': '2024-06-01T12:00:00.000Z', 'isExpense': False, 'icon': 'cash'})
+    db.put(path, data)
+    model = CountingModel()
+    stats = batch_insights.run(db, model, page_size=2, checkpoint_path=checkpoint)
+    assert (stats['updated'], stats['skipped']) == (1, 4)
+    assert model.calls == 1
+    assert db.docs[path]['analytics']['total_income'] == 100
+
+
+def test_write_that_does_not_change_insight_data_is_skipped(checkpoint):
+    db = make_db(2)
+    batch_insights.run(db, CountingModel(), checkpoint_path=checkpoint)
+    path = 'users/user001/finance/financial_data'
+    data = db.docs[path]
+    data['budget'] = 2000
+    db.put(path, data)
+    model = CountingModel()
+    stats = batch_insights.run(db, model, checkpoint_path=checkpoint)
+    assert (stats['updated'], stats['skipped']) == (0, 2)
+    assert model.calls == 0
+    # The state now matches, the next run is metadata only again
+    db.full_finance_reads = 0
+    batch_insights.run(db, model, checkpoint_path=checkpoint)
+    assert db.full_finance_reads == 0
+
+
+def test_user_without_transactions_uses_no_llm_quota(checkpoint):
+    db = make_db(1)
+    db.put('users/user001', {'email': 'new@example.com'})
+    db.put('users/user001/finance/financial_data', {'budget': 1000, 'transactions': [], 'custom_categories': []})
+    model = CountingModel()
+    stats = batch_insights.run(db, model, checkpoint_path=checkpoint)
+    assert (stats['updated'], stats['failed']) == (2, 0)
+    assert model.calls == 1
+    finance = db.docs['users/user001/finance/financial_data']
+    assert finance['insights'] == []
+    assert finance['analytics']['transaction_count'] == 0
+    # Recorded as current, later runs skip the user from metadata
+    stats = batch_insights.run(db, model, checkpoint_path=checkpoint)
+    assert stats['skipped'] == 2
+
+
+def test_interrupted_run_resumes_from_checkpoint(checkpoint):
+    db = make_db(5)
+    db.fail_stream_after = 1
+    with pytest.raises(ConnectionError):
+        batch_insights.run(db, CountingModel(), page_size=2, checkpoint_path=checkpoint)
+    saved = batch_insights.load_checkpoint(checkpoint)
+    assert saved['last_user_id'] == 'user001'
+    assert saved['stats']['updated'] == 2
+
+    db.fail_stream_after = None
+    model = CountingModel()
+    stats = batch_insights.run(db, model, page_size=2, checkpoint_path=checkpoint)
+    assert model.calls == 3
+    assert (stats['scanned'], stats['updated']) == (5, 5)
+    assert batch_insights.load_checkpoint(checkpoint) is None
+
+
+def test_restart_ignores_checkpoint(checkpoint):
+    db = make_db(3)
+    batch_insights.save_checkpoint(checkpoint, {'last_user_id': 'user001', 'stats': {
+        'scanned': 2, 'updated': 2, 'skipped': 0, 'failed': 0}})
+    stats = batch_insights.run(db, CountingModel(), checkpoint_path=checkpoint, restart=True)
+    assert (stats['scanned'], stats['updated']) == (3, 3)
+
+
+def test_concurrent_modification_is_not_marked_processed(checkpoint, monkeypatch):
+    db = make_db(1)
+    path = 'users/user000/finance/financial_data'
+
+    class EditingModel(CountingModel):
+        def invoke(self, prompt):
+            # The user adds an expense while insights are being generated
+            db.put(path, db.docs[path])
+            return super().invoke(prompt)
+    stats = batch_insights.run(db, EditingModel(), checkpoint_path=checkpoint)
+    assert stats['failed'] == 1
+    assert f'users/user000/finance/{INSIGHTS_STATE_DOCUMENT}' not in db.docs
+
+
+def test_llm_concurrency_holds_when_llm_outlives_deadline(checkpoint, monkeypatch):
+    monkeypatch.setattr(batch_insights, 'USER_DEADLINE_SECONDS', 0.05)
+    db = make_db(6)
+    model = CountingModel(latency_seconds=0.2)
+    stats = batch_insights.run(db, model, page_size=6, llm_concurrency=2, checkpoint_path=checkpoint)
+    assert stats['failed'] == 6
+    assert model.max_in_flight <= 2
+
+
+def test_fake_model_honours_timeout():
+    model = batch_insights.FakeInsightsModel(latency_seconds=0.5)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        batch_insights.invoke_insights(model, 'prompt', timeout=0.02)
+    assert time.monotonic() - started < 0.3
+    assert batch_insights.invoke_insights(batch_insights.FakeInsightsModel(), 'Title: a\n', timeout=1)['insights']
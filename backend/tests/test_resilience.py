@@ -0,0 +1,280 @@
+import time
+import threading
+import pytest
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded, DependencyError
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    # Breakers and pools are process wide, give every test its own
+    monkeypatch.setattr(resilience, '_breakers', {})
+    monkeypatch.setattr(resilience, '_pools', {})
+    monkeypatch.setattr(resilience, 'BACKOFF_BASE_SECONDS', 0.001)
+
+
+def slow(seconds, result='ok'):
+    def fn(timeout):
+        time.sleep(seconds)
+        return result
+    return fn
+
+
+def failing(error, times):
+    """Raises error the first `times` calls, then returns the number of calls"""
+    calls = []
+
+    def fn(timeout):
+        calls.append(timeout)
+        if len(calls) <= times:
+            raise error
+        return len(calls)
+    fn.calls = calls
+    return fn
+
+
+# CircuitBreaker
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker('dep', failure_threshold=3, reset_seconds=60)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.before_call()
+    assert 0 < excinfo.value.retry_after <= 60
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker('dep', failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.before_call()
+
+
+def test_breaker_lets_one_trial_through_after_reset():
+    breaker = CircuitBreaker('dep', failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    time.sleep(0.06)
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_breaker_failed_trial_reopens():
+    breaker = CircuitBreaker('dep', failure_threshold=5, reset_seconds=0.05)
+    for _ in range(5):
+        breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_breaker_released_trial_allows_another():
+    breaker = CircuitBreaker('dep', failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+
+
+# _attempt
+
+def test_attempt_returns_result():
+    assert resilience._attempt('dep', slow(0), Deadline(1), None) == 'ok'
+
+
+def test_attempt_passes_remaining_budget():
+    seen = []
+    resilience._attempt('dep', lambda timeout: seen.append(timeout), Deadline(1), None)
+    assert 0.9 < seen[0] <= 1
+
+
+def test_attempt_abandons_at_deadline():
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        resilience._attempt('dep', slow(0.5), Deadline(0.05), None)
+    assert time.monotonic() - started < 0.3
+
+
+def test_attempt_raises_error_from_fn():
+    with pytest.raises(ValueError):
+        resilience._attempt('dep', failing(ValueError('bad'), 1), Deadline(1), None)
+
+
+def test_attempt_hedges_slow_call():
+    calls = []
+
+    def fn(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return 'first'
+        return 'hedge'
+    started = time.monotonic()
+    assert resilience._attempt('dep', fn, Deadline(1), hedge_after=0.02) == 'hedge'
+    assert time.monotonic() - started < 0.3
+    assert len(calls) == 2
+
+
+def test_attempt_does_not_hedge_fast_call():
+    calls = []
+    resilience._attempt('dep', lambda timeout: calls.append(timeout), Deadline(1), hedge_after=0.2)
+    assert len(calls) == 1
+
+
+def test_attempt_skips_hedge_without_spare_capacity():
+    resilience.configure_pool('dep', 1)
+    calls = []
+
+    def fn(timeout):
+        calls.append(timeout)
+        time.sleep(0.1)
+        return 'ok'
+    assert resilience._attempt('dep', fn, Deadline(1), hedge_after=0.01) == 'ok'
+    assert len(calls) == 1
+
+
+# call
+
+def test_call_retries_transient_errors():
+    fn = failing(ConnectionError('blip'), 2)
+    assert resilience.call('dep', fn, idempotent=True, deadline=Deadline(1)) == 3
+    assert resilience.get_breaker('dep').failures == 0
+
+
+def test_call_does_not_retry_non_idempotent():
+    fn = failing(ConnectionError('blip'), 1)
+    with pytest.raises(DependencyError):
+        resilience.call('dep', fn, deadline=Deadline(1))
+    assert len(fn.calls) == 1
+
+
+def test_call_counts_one_failure_per_call():
+    fn = failing(ConnectionError('down'), 10)
+    with pytest.raises(DependencyError):
+        resilience.call('dep', fn, idempotent=True, deadline=Deadline(1))
+    assert len(fn.calls) == resilience.MAX_RETRIES + 1
+    assert resilience.get_breaker('dep').failures == 1
+
+
+def test_call_stops_retrying_when_backoff_passes_deadline(monkeypatch):
+    monkeypatch.setattr(resilience.random, 'uniform', lambda low, high: 5.0)
+    fn = failing(ConnectionError('blip'), 1)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        resilience.call('dep', fn, idempotent=True, deadline=Deadline(0.5))
+    assert time.monotonic() - started < 0.2
+    assert len(fn.calls) == 1
+    assert resilience.get_breaker('dep').failures == 1
+
+
+def test_call_non_transient_error_is_not_a_failure():
+    resilience.get_breaker('dep').record_failure()
+    with pytest.raises(KeyError):
+        resilience.call('dep', failing(KeyError('missing'), 1), idempotent=True, deadline=Deadline(1))
+    assert resilience.get_breaker('dep').failures == 0
+
+
+def test_call_rejects_when_breaker_open():
+    breaker = resilience.get_breaker('dep')
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    fn = failing(ConnectionError('down'), 0)
+    with pytest.raises(CircuitOpenError):
+        resilience.call('dep', fn, deadline=Deadline(1))
+    assert fn.calls == []
+
+
+def test_client_shortened_timeouts_do_not_trip_breaker():
+    for _ in range(resilience.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(DeadlineExceeded):
+            resilience.call('dep', slow(0.2), idempotent=True, deadline=Deadline(0.05, client_shortened=True))
+    assert resilience.get_breaker('dep').failures == 0
+    assert resilience.call('dep', slow(0), deadline=Deadline(1)) == 'ok'
+
+
+def test_server_budget_timeouts_trip_breaker():
+    for _ in range(resilience.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(DeadlineExceeded):
+            resilience.call('dep', slow(0.2), deadline=Deadline(0.02))
+    with pytest.raises(CircuitOpenError):
+        resilience.call('dep', slow(0), deadline=Deadline(1))
+
+
+def test_call_with_expired_deadline_does_not_call():
+    fn = failing(ConnectionError('down'), 0)
+    deadline = Deadline(0)
+    with pytest.raises(DeadlineExceeded):
+        resilience.call('dep', fn, deadline=deadline)
+    assert fn.calls == []
+
+
+def test_slow_dependency_does_not_starve_others():
+    resilience.configure_pool('gemini', 2)
+    release = threading.Event()
+    for _ in range(2):
+        with pytest.raises(DeadlineExceeded):
+            resilience.call('gemini', lambda timeout: release.wait(1), deadline=Deadline(0.02))
+    # Both gemini slots are still held by the abandoned calls
+    with pytest.raises(DeadlineExceeded):
+        resilience.call('gemini', slow(0), deadline=Deadline(0.02))
+    assert resilience.call('firestore', slow(0), deadline=Deadline(0.5)) == 'ok'
+    release.set()
+
+
+def test_timed_out_call_frees_its_slot():
+    resilience.configure_pool('firestore', 1)
+
+    def honours_timeout(timeout):
+        # Like a Firestore call made with retry=None: gives up shortly after its timeout is spent
+        time.sleep(timeout + 0.02)
+        raise TimeoutError('deadline')
+    with pytest.raises(DeadlineExceeded):
+        resilience.call('firestore', honours_timeout, deadline=Deadline(0.05))
+    time.sleep(0.1)
+    assert resilience.call('firestore', slow(0), deadline=Deadline(0.01)) == 'ok'
+
+
+def test_firebase_errors_are_transient():
+    firebase_exceptions = pytest.importorskip('firebase_admin.exceptions')
+    error = firebase_exceptions.UnavailableError('auth is down')
+    fn = failing(error, 1)
+    assert resilience.call('firebase_auth', fn, idempotent=True, deadline=Deadline(1)) == 2
+
+
+def test_certificate_fetch_errors_are_transient():
+    auth = pytest.importorskip('firebase_admin.auth')
+    fn = failing(auth.CertificateFetchError('keys unavailable', cause=None), 1)
+    assert resilience.call('firebase_auth', fn, idempotent=True, deadline=Deadline(1)) == 2
+
+
+# Request deadlines
+
+@pytest.mark.parametrize('header, seconds, shortened', [
+    (None, resilience.REQUEST_DEADLINE_SECONDS, False),
+    ('', resilience.REQUEST_DEADLINE_SECONDS, False),
+    ('abc', resilience.REQUEST_DEADLINE_SECONDS, False),
+    ('999999', resilience.REQUEST_DEADLINE_SECONDS, False),
+    ('500', 0.5, True),
+    ('-5', 0, True),
+])
+def test_start_request_deadline(header, seconds, shortened):
+    flask = pytest.importorskip('flask')
+    app = flask.Flask(__name__)
+    with app.test_request_context('/'):
+        deadline = resilience.start_request_deadline(header)
+        assert deadline.remaining() == pytest.approx(seconds, abs=0.05)
+        assert deadline.client_shortened is shortened
+        assert resilience.current_deadline() is deadline
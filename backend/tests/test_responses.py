@@ -0,0 +1,99 @@
+import gzip
+import json
+import datetime
+import pytest
+import responses
+
+
+class Timestamp(datetime.datetime):
+    """Stands in for Firestore's DatetimeWithNanoseconds"""
+
+
+def test_parse_fields_empty():
+    assert responses.parse_fields('') is None
+    assert responses.parse_fields(None) is None
+    assert responses.parse_fields(' , ') is None
+
+
+def test_parse_fields_whole_and_nested():
+    fields = responses.parse_fields('custom_categories, transactions.id,transactions.amount')
+    assert fields == {'custom_categories': None, 'transactions': {'id', 'amount'}}
+
+
+def test_parse_fields_whole_field_wins_over_subfields():
+    assert responses.parse_fields('transactions.id,transactions') == {'transactions': None}
+    assert responses.parse_fields('transactions,transactions.id') == {'transactions': None}
+
+
+def test_sparse_trims_lists_of_dicts_and_keeps_error():
+    payload = {
+        'transactions': [{'id': '1', 'amount': 5, 'title': 'Lunch'}],
+        'custom_categories': [{'id': '1'}],
+        'error': False,
+    }
+    trimmed = responses.sparse(payload, {'transactions': {'id', 'amount'}})
+    assert trimmed == {'transactions': [{'id': '1', 'amount': 5}], 'error': False}
+
+
+def test_sparse_without_fields_returns_payload():
+    payload = {'a': 1}
+    assert responses.sparse(payload, None) is payload
+
+
+def test_sparse_ignores_unknown_fields():
+    assert responses.sparse({'a': 1, 'error': False}, {'missing': None}) == {'error': False}
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('', None),
+    ('gzip', 'gzip'),
+    ('gzip, deflate', 'gzip'),
+    ('br;q=0.1, gzip;q=1', 'gzip'),
+    ('br;q=0, gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('gzip;foo=1;q=0', None),
+    ('br;level=1; Q=0.2, gzip;q=0.5', 'gzip'),
+    ('identity', None),
+    ('gzip;q=0.5, identity;q=1', None),
+    ('*', 'br'),
+    ('br, gzip', 'br'),
+])
+def test_choose_encoding(monkeypatch, header, expected):
+    monkeypatch.setattr(responses, 'brotli', object())
+    assert responses.choose_encoding(header) == expected
+
+
+def test_choose_encoding_without_brotli(monkeypatch):
+    monkeypatch.setattr(responses, 'brotli', None)
+    assert responses.choose_encoding('br, gzip;q=0.5') == 'gzip'
+    assert responses.choose_encoding('br') is None
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_dumps_encodes_datetime_subclasses(monkeypatch, use_orjson):
+    if use_orjson and responses.orjson is None:
+        pytest.skip('orjson is not installed')
+    if not use_orjson:
+        monkeypatch.setattr(responses, 'orjson', None)
+    stamp = Timestamp(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    assert json.loads(responses.dumps({'date': stamp})) == {'date': '2024-05-01T12:30:00+00:00'}
+
+
+def test_api_response_compresses_large_bodies():
+    flask = pytest.importorskip('flask')
+    app = flask.Flask(__name__)
+    payload = {'transactions': [{'id': str(i), 'amount': i} for i in range(500)], 'error': False}
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+        response = responses.api_response(payload)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.get_data())) == payload
+
+
+def test_api_response_leaves_small_bodies_uncompressed():
+    flask = pytest.importorskip('flask')
+    app = flask.Flask(__name__)
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+        response = responses.api_response({'error': False})
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.get_data()) == {'error': False}